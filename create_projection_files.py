@@ -2,22 +2,44 @@
 from __future__ import annotations
 
 import argparse
+import fnmatch
+import hashlib
+import os
+import pickle
 import re
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple, Dict
-import xml.etree.ElementTree as ET
+from typing import Optional, Tuple, Dict, List
 
-from PIL import Image
+try:
+    # lxml parses/serializes in C, typically several times faster
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+import numpy as np
 
 
-LEADING_WEIRD = re.compile(r"^[0-9a-fA-F]{8}-")            # 00bb88ea-
 LAST_TWO = re.compile(r"_(?P<a>\d+)_(?P<b>\d+)$")          # ending _2_1
-# base + frame: "...<base>.jpg_<frame>_..."
-REF_FROM_TILE = re.compile(r"(?P<base>.+?)\.(jpg|jpeg)_(?P<frame>\d+)_", re.IGNORECASE)
+# single pass over the stem: optional leading weirdness ("00bb88ea-"),
+# then base + frame ("...<base>.jpg_<frame>_...") with a frameless fallback
+TILE_STEM = re.compile(
+    r"^(?:[0-9a-fA-F]{8}-)?"
+    r"(?:(?P<base>.+?)\.(?:jpg|jpeg)_(?P<frame>\d+)_"
+    r"|(?P<base_nf>.+?)\.(?:jpg|jpeg))",
+    re.IGNORECASE,
+)
+
+# cheap pre-filter applied before any regex work on a directory entry
+TILE_SUFFIXES = (".jpg", ".jpeg", ".png")
 
+# placeholder baked into the serialized reference template; per-tile output
+# is then a plain bytes.replace instead of an XML clone+serialize
+GT_SENTINEL = b"__GT_SENTINEL__"
 
-def normalize_stem(stem: str) -> str:
-    return LEADING_WEIRD.sub("", stem)
+# disk cache for parsed reference templates, reused across script runs
+GEOREF_CACHE_DIR = ".georef_cache"
 
 
 def parse_last_two(stem: str) -> Optional[Tuple[int, int]]:
@@ -27,23 +49,44 @@ def parse_last_two(stem: str) -> Optional[Tuple[int, int]]:
     return int(m.group("a")), int(m.group("b"))
 
 
-def extract_ref_base_and_frame(normalized_stem: str) -> Optional[Tuple[str, Optional[str]]]:
-    m = REF_FROM_TILE.search(normalized_stem)
-    if m:
-        return m.group("base"), m.group("frame")
-    # fallback: just "...<base>.jpg..."
-    m2 = re.search(r"(?P<base>.+?)\.(jpg|jpeg)", normalized_stem, re.IGNORECASE)
-    if not m2:
+def parse_tile_stem(stem: str) -> Optional[Tuple[str, Optional[str]]]:
+    m = TILE_STEM.match(stem)
+    if not m:
         return None
-    return m2.group("base"), None
+    base = m.group("base")
+    if base is not None:
+        return base, m.group("frame")
+    return m.group("base_nf"), None
+
+
+def iter_tiles(root: Path, pattern: str, recursive: bool):
+    """
+    Yield os.DirEntry objects for files under root matching the glob pattern.
+    scandir skips the per-entry Path construction and implicit stat() that
+    pathlib.glob/rglob pay for, which dominates on big tile directories.
+    """
+    match = re.compile(fnmatch.translate(pattern)).match
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and match(entry.name):
+                    yield entry
 
 
 def build_ref_index(refs_dir: Path, recursive: bool) -> Dict[str, Path]:
-    it = refs_dir.rglob("*.jp*g") if recursive else refs_dir.glob("*.jp*g")
-    return {p.name.lower(): p for p in it if p.is_file()}
+    # scandir walk: DirEntry.is_file() answers from cached d_type, so no
+    # extra stat per reference
+    return {e.name.lower(): Path(e.path) for e in iter_tiles(refs_dir, "*.jp*g", recursive)}
 
 
-def choose_reference(ref_index: Dict[str, Path], base: str, frame: Optional[str]) -> Optional[Path]:
+def choose_reference(ref_index: Dict[str, Path],
+                     ref_keys_sorted: List[str],
+                     base: str,
+                     frame: Optional[str]) -> Optional[Path]:
     """
     Try common on-disk names:
       base.jpg
@@ -61,18 +104,20 @@ def choose_reference(ref_index: Dict[str, Path], base: str, frame: Optional[str]
         if p:
             return p
 
-    # fuzzy fallback
+    # fuzzy fallback: names sharing the prefix sit in one contiguous run of
+    # the sorted key list, so bisect to it instead of scanning every key
     base_l = base.lower()
     frame_l = frame.lower() if frame else None
     best = None
     best_len = 10**9
-    for name_l, p in ref_index.items():
+    for i in range(bisect_left(ref_keys_sorted, base_l), len(ref_keys_sorted)):
+        name_l = ref_keys_sorted[i]
         if not name_l.startswith(base_l):
-            continue
+            break
         if frame_l and frame_l not in name_l:
             continue
         if len(name_l) < best_len:
-            best = p
+            best = ref_index[name_l]
             best_len = len(name_l)
     return best
 
@@ -85,23 +130,38 @@ def parse_geotransform_text(gt_text: str) -> Tuple[float, float, float, float, f
     return tuple(float(x) for x in parts)  # type: ignore
 
 
-def format_geotransform(gt: Tuple[float, float, float, float, float, float]) -> str:
-    # Match GDAL-ish style: leading spaces + comma-separated
-    return "  " + ", ".join(f"{v:.16e}" for v in gt)
-
-
-def shifted_geotransform(gt: Tuple[float, float, float, float, float, float],
-                         col_off_px: int,
-                         row_off_px: int) -> Tuple[float, float, float, float, float, float]:
+def format_geotransforms(new_GT0: np.ndarray,
+                         new_GT3: np.ndarray,
+                         gt: Tuple[float, float, float, float, float, float]) -> List[bytes]:
+    """
+    Format the GT text for all tiles of a reference in one pass
+    (GDAL-ish style: leading spaces + comma-separated, %.16e).
+    """
+    _, GT1, GT2, _, GT4, GT5 = gt
+    n = len(new_GT0)
+    gt_arr = np.column_stack((
+        new_GT0, np.full(n, GT1), np.full(n, GT2),
+        new_GT3, np.full(n, GT4), np.full(n, GT5),
+    ))
+    formatted = np.char.mod("%.16e", gt_arr)
+    return [("  " + ", ".join(row)).encode("ascii") for row in formatted]
+
+
+def shifted_geotransforms(gt: Tuple[float, float, float, float, float, float],
+                          cols: np.ndarray,
+                          rows: np.ndarray,
+                          stride: int) -> Tuple[np.ndarray, np.ndarray]:
     """
     GDAL geotransform:
       Xgeo = GT0 + col*GT1 + row*GT2
       Ygeo = GT3 + col*GT4 + row*GT5
+    Computes the shifted origins for all tiles of a reference at once;
+    GT1/GT2/GT4/GT5 are unchanged by the shift.
     """
     GT0, GT1, GT2, GT3, GT4, GT5 = gt
-    new_GT0 = GT0 + col_off_px * GT1 + row_off_px * GT2
-    new_GT3 = GT3 + col_off_px * GT4 + row_off_px * GT5
-    return (new_GT0, GT1, GT2, new_GT3, GT4, GT5)
+    new_GT0 = GT0 + cols * stride * GT1 + rows * stride * GT2
+    new_GT3 = GT3 + cols * stride * GT4 + rows * stride * GT5
+    return new_GT0, new_GT3
 
 
 def ensure_metadata_blocks(root: ET.Element) -> None:
@@ -112,21 +172,154 @@ def ensure_metadata_blocks(root: ET.Element) -> None:
     return
 
 
-def update_geotransform_in_auxxml(aux_tree: ET.ElementTree, new_gt: Tuple[float, float, float, float, float, float]) -> None:
+def jpeg_dims(path: str) -> Optional[Tuple[int, int]]:
+    """
+    Read (height, width) from the JPEG SOF marker in the first few KB.
+    Cheap readability check that avoids a full Pillow open per tile.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read(65536)
+    except OSError:
+        return None
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        # SOF0..SOF15 (minus DHT/DAC/RST which share the range)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(data[i + 5:i + 7], "big"), int.from_bytes(data[i + 7:i + 9], "big")
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def load_ref_template(ref_aux: Path) -> Tuple[bytes, Tuple[float, float, float, float, float, float]]:
+    aux_tree = ET.parse(str(ref_aux))  # str: older lxml won't take a Path
     root = aux_tree.getroot()
+    if root.tag != "PAMDataset":
+        raise RuntimeError(f"Unexpected root tag: {root.tag}")
     gt_el = root.find("GeoTransform")
-    if gt_el is None:
-        # Create it near the top after SRS, to mimic GDAL structure.
-        srs_el = root.find("SRS")
-        gt_el = ET.Element("GeoTransform")
-        if srs_el is not None:
-            # insert after SRS
-            idx = list(root).index(srs_el) + 1
-            root.insert(idx, gt_el)
-        else:
-            root.insert(0, gt_el)
+    if gt_el is None or not (gt_el.text and gt_el.text.strip()):
+        raise RuntimeError("Reference aux.xml missing GeoTransform text")
+    ref_gt = parse_geotransform_text(gt_el.text)
+    ensure_metadata_blocks(root)
+    # serialize once with a sentinel where the GeoTransform text goes;
+    # every tile's aux.xml is then template_bytes with the sentinel swapped
+    gt_el.text = GT_SENTINEL.decode("ascii")
+    template_bytes = ET.tostring(root, encoding="unicode").encode("utf-8")
+    return template_bytes, ref_gt
+
+
+def load_ref_template_cached(ref_aux: Path) -> Tuple[bytes, Tuple[float, float, float, float, float, float]]:
+    """
+    Disk-backed wrapper around load_ref_template keyed on (path, mtime, size),
+    so repeated runs over the same references skip the XML parse entirely.
+    Stale entries invalidate themselves via the stat-based key.
+    """
+    st = os.stat(ref_aux)
+    key = hashlib.sha1(f"{ref_aux}|{st.st_mtime_ns}|{st.st_size}".encode()).hexdigest()
+    cache_path = os.path.join(GEOREF_CACHE_DIR, key + ".pkl")
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        pass
+
+    result = load_ref_template(ref_aux)
+
+    # tmp + rename so concurrent workers never read a half-written entry
+    os.makedirs(GEOREF_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return result
+
+
+def process_group(job: Tuple[str, List[Tuple[str, int, int]], int, bool]) -> Tuple[int, int, int, int]:
+    """
+    Handle every tile of one reference inside a single worker, so the parsed
+    aux.xml template and base GT stay local to the process.
+    Returns (processed, skipped, unchanged, bad_ref) counters for the group.
+    """
+    ref_jpg_str, tiles, stride, debug = job
+    ref_jpg = Path(ref_jpg_str)
 
-    gt_el.text = format_geotransform(new_gt)
+    ref_aux = Path(str(ref_jpg) + ".aux.xml")  # reference.jpg.aux.xml
+    if not ref_aux.exists():
+        if debug:
+            print(f"[BAD REF] Missing aux: {ref_aux}")
+        return 0, 0, 0, len(tiles)
+
+    try:
+        template_bytes, ref_gt = load_ref_template_cached(ref_aux)
+    except Exception as e:
+        print(f"[BAD REF] {ref_aux.name}: {e}")
+        return 0, 0, 0, len(tiles)
+
+    processed = 0
+    skipped = 0
+    unchanged = 0
+
+    # bind hot-loop callables to locals: saves an attribute/global lookup
+    # per call, which adds up over very large groups
+    _replace = template_bytes.replace
+    _stat, _open, _write, _close = os.stat, os.open, os.write, os.close
+    _rename = os.replace
+    _jpeg_dims = jpeg_dims
+
+    # process in path order so writes land directory-by-directory, which
+    # keeps metadata/inode updates local on big multi-directory runs
+    tiles = sorted(tiles)
+
+    # tile indices -> pixel offsets -> shifted origins -> GT texts,
+    # all batched per reference group
+    rows = np.fromiter((t[1] for t in tiles), dtype=np.int64, count=len(tiles))
+    cols = np.fromiter((t[2] for t in tiles), dtype=np.int64, count=len(tiles))
+    new_GT0, new_GT3 = shifted_geotransforms(ref_gt, cols, rows, stride)
+    gt_texts = format_geotransforms(new_GT0, new_GT3, ref_gt)
+
+    for i, (tile_str, tile_row, tile_col) in enumerate(tiles):
+        # tile size (not strictly needed unless you later handle flips);
+        # the SOF scan doubles as a cheap readability check
+        # only JPEGs get the probe; other suffixes (e.g. a PNG tiles-glob)
+        # pass straight through
+        if tile_str.lower().endswith((".jpg", ".jpeg")) and _jpeg_dims(tile_str) is None:
+            skipped += 1
+            continue
+
+        # single raw write instead of a per-tile XML clone+serialize
+        xml_bytes = _replace(GT_SENTINEL, gt_texts[i])
+        out_aux = tile_str + ".aux.xml"
+
+        # resume-safe reruns: skip the write only when the existing sidecar
+        # is byte-identical (size alone can't tell - the GT text is
+        # fixed-width, so e.g. a different --stride aliases the length)
+        try:
+            if _stat(out_aux).st_size == len(xml_bytes):
+                with open(out_aux, "rb") as f:
+                    if f.read() == xml_bytes:
+                        unchanged += 1
+                        continue
+        except OSError:
+            pass
+
+        # tmp + atomic rename: an interrupted run never leaves a partial
+        # sidecar behind for the content gate above to mistake for a finished one
+        tmp_aux = f"{out_aux}.{os.getpid()}.tmp"
+        fd = _open(tmp_aux, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        _write(fd, xml_bytes)
+        _close(fd)
+        _rename(tmp_aux, out_aux)
+
+        processed += 1
+        if debug and processed <= 5:
+            print(f"[OK] {os.path.basename(tile_str)} -> {os.path.basename(out_aux)} using ref={ref_jpg.name} row={tile_row} col={tile_col}")
+
+    return processed, skipped, unchanged, 0
 
 
 def main() -> int:
@@ -141,6 +334,7 @@ def main() -> int:
     ap.add_argument("--recursive-tiles", action="store_true")
     ap.add_argument("--swap-rowcol", action="store_true", help="Interpret last _A_B as col_row instead of row_col")
     ap.add_argument("--tiles-glob", default="*.jp*g")
+    ap.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
     ap.add_argument("--debug", action="store_true")
     args = ap.parse_args()
 
@@ -156,26 +350,40 @@ def main() -> int:
     ref_index = build_ref_index(refs_dir, args.recursive_refs)
     if not ref_index:
         raise SystemExit("No reference JPGs found.")
+    ref_keys_sorted = sorted(ref_index)
 
-    # cache parsed reference aux.xml and GT
-    ref_cache: Dict[Path, Tuple[ET.ElementTree, Tuple[float, float, float, float, float, float]]] = {}
-
-    tile_iter = tiles_dir.rglob(args.tiles_glob) if args.recursive_tiles else tiles_dir.glob(args.tiles_glob)
+    tile_iter = iter_tiles(tiles_dir, args.tiles_glob, args.recursive_tiles)
 
     processed = 0
     skipped = 0
+    unchanged = 0
     no_ref = 0
     bad_ref = 0
 
     from tqdm import tqdm
-    import os
 
-    for tile_path in tqdm(tile_iter, total=len([file for file in os.listdir(tiles_dir) if file.endswith(".jpg")])):
-        if not tile_path.is_file():
+    # group tiles by resolved reference, so each worker parses the aux.xml once
+    groups: Dict[Path, List[Tuple[str, int, int]]] = {}
+
+    # local bindings for the scan loop, same rationale as in process_group
+    _parse_last_two = parse_last_two
+    _parse_tile_stem = parse_tile_stem
+    _splitext = os.path.splitext
+
+    # no eager total: listdir-counting doubled the directory walk and was
+    # wrong for recursive runs anyway; tqdm copes fine with an unknown total
+    for entry in tqdm(tile_iter, unit="tile"):
+        name = entry.name
+
+        # a real tile name has an image suffix and at least "_A_B" in it;
+        # reject everything else before paying for the regex
+        if not name.lower().endswith(TILE_SUFFIXES) or name.count("_") < 2:
+            skipped += 1
             continue
+        stem = _splitext(name)[0]
 
         # only handle actual tiles that end with _A_B
-        last = parse_last_two(tile_path.stem)
+        last = _parse_last_two(stem)
         if last is None:
             skipped += 1
             continue
@@ -185,74 +393,34 @@ def main() -> int:
         else:
             tile_row, tile_col = a, b
 
-        normalized = normalize_stem(tile_path.stem)
-        base_frame = extract_ref_base_and_frame(normalized)
+        base_frame = _parse_tile_stem(stem)
         if base_frame is None:
             skipped += 1
             continue
         base, frame = base_frame
 
-        ref_jpg = choose_reference(ref_index, base, frame)
+        ref_jpg = choose_reference(ref_index, ref_keys_sorted, base, frame)
         if ref_jpg is None:
             no_ref += 1
             if args.debug:
-                print(f"[NO REF] {tile_path.name} base={base!r} frame={frame!r}")
-            continue
-
-        ref_aux = Path(str(ref_jpg) + ".aux.xml")  # reference.jpg.aux.xml
-        if not ref_aux.exists():
-            bad_ref += 1
-            if args.debug:
-                print(f"[BAD REF] Missing aux: {ref_aux}")
-            continue
-
-        # cache reference tree + base GT
-        if ref_jpg not in ref_cache:
-            try:
-                aux_tree = ET.parse(ref_aux)
-                root = aux_tree.getroot()
-                if root.tag != "PAMDataset":
-                    raise RuntimeError(f"Unexpected root tag: {root.tag}")
-                gt_el = root.find("GeoTransform")
-                if gt_el is None or not (gt_el.text and gt_el.text.strip()):
-                    raise RuntimeError("Reference aux.xml missing GeoTransform text")
-                ref_gt = parse_geotransform_text(gt_el.text)
-                ensure_metadata_blocks(root)
-                ref_cache[ref_jpg] = (aux_tree, ref_gt)
-            except Exception as e:
-                bad_ref += 1
-                print(f"[BAD REF] {ref_aux.name}: {e}")
-                continue
-
-        # read tile size (not strictly needed unless you later handle flips)
-        try:
-            with Image.open(tile_path) as im:
-                _w, _h = im.size
-        except Exception:
-            skipped += 1
+                print(f"[NO REF] {name} base={base!r} frame={frame!r}")
             continue
 
-        aux_tree_template, ref_gt = ref_cache[ref_jpg]
-
-        # Compute tile GT using tile indices -> pixel offsets
-        row_off = tile_row * stride
-        col_off = tile_col * stride
-        tile_gt = shifted_geotransform(ref_gt, col_off_px=col_off, row_off_px=row_off)
+        groups.setdefault(ref_jpg, []).append((entry.path, tile_row, tile_col))
 
-        # IMPORTANT: clone the tree so we don't mutate the cached template
-        aux_tree = ET.ElementTree(ET.fromstring(ET.tostring(aux_tree_template.getroot(), encoding="utf-8")))
+    jobs = [(str(ref_jpg), tiles, stride, args.debug) for ref_jpg, tiles in groups.items()]
+    workers = args.workers if args.workers is not None else os.cpu_count()
 
-        update_geotransform_in_auxxml(aux_tree, tile_gt)
-
-        out_aux = Path(str(tile_path) + ".aux.xml")
-        aux_tree.write(out_aux, encoding="UTF-8", xml_declaration=False)
-
-        processed += 1
-        if args.debug and processed <= 5:
-            print(f"[OK] {tile_path.name} -> {out_aux.name} using ref={ref_jpg.name} row={tile_row} col={tile_col}")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for group_processed, group_skipped, group_unchanged, group_bad in tqdm(executor.map(process_group, jobs), total=len(jobs), unit="ref"):
+            processed += group_processed
+            skipped += group_skipped
+            unchanged += group_unchanged
+            bad_ref += group_bad
 
     print("Done.")
     print(f"Processed tiles (wrote aux.xml): {processed}")
+    print(f"Already up to date (identical aux.xml): {unchanged}")
     print(f"No matching reference: {no_ref}")
     print(f"Skipped (non-tiles or parse/read issues): {skipped}")
     print(f"Bad references (missing/broken aux.xml): {bad_ref}")
@@ -1,24 +1,23 @@
 import os
+import numpy as np
 from PIL import Image
+import matplotlib
+matplotlib.use("Agg")  # non-interactive: we only ever save to files
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.collections import PatchCollection
 from pathlib import Path
 
 # ==== CONFIG – CHANGE THESE ====
 main_path = r"C:\Users\Wojtek\Documents\GitHub\Tools\magisterka\temp_augment_data_dir_LARGER_augment_resized"
 # ===============================
 
-def load_yolo_annotations(label_path, img_width, img_height):
+def parse_yolo_lines(label_path):
     """
-    Reads YOLO txt file and returns list of:
-    (class_id, x_min, y_min, box_width, box_height) in pixel coordinates.
+    Line-by-line fallback for label files with malformed rows.
+    Returns an (N, 5) float32 array of valid "class xc yc w h" rows.
     """
-    boxes = []
-
-    if not os.path.exists(label_path):
-        print(f"Label file not found: {label_path}")
-        return boxes
-
+    rows = []
     with open(label_path, "r") as f:
         for line in f:
             line = line.strip()
@@ -31,48 +30,76 @@ def load_yolo_annotations(label_path, img_width, img_height):
                 print(f"Skipping invalid line: {line}")
                 continue
 
-            cls = int(parts[0])
-            xc, yc, w, h = map(float, parts[1:])
+            rows.append([float(p) for p in parts])
 
-            # Convert normalized to pixel coords
-            x_center = xc * img_width
-            y_center = yc * img_height
-            box_w    = w  * img_width
-            box_h    = h  * img_height
+    return np.array(rows, dtype=np.float32).reshape(-1, 5)
 
-            x_min = x_center - box_w / 2
-            y_min = y_center - box_h / 2
-
-            boxes.append((cls, x_min, y_min, box_w, box_h))
-
-    return boxes
-
-def visualize_image_with_boxes(main_path,image_path, label_path):
-    # Load image
-    img = Image.open(image_path).convert("RGB")
+def load_yolo_annotations(label_path, img_width, img_height):
+    """
+    Reads YOLO txt file and returns list of:
+    (class_id, x_min, y_min, box_width, box_height) in pixel coordinates.
+    """
+    if not os.path.exists(label_path):
+        print(f"Label file not found: {label_path}")
+        return []
+
+    if os.path.getsize(label_path) == 0:
+        return []
+
+    # one vectorized parse for the common case; fall back to the slow
+    # per-line parser when the file contains invalid rows
+    try:
+        data = np.loadtxt(label_path, dtype=np.float32, ndmin=2)
+        if data.size and data.shape[1] != 5:
+            raise ValueError("expected 5 columns")
+    except ValueError:
+        data = parse_yolo_lines(label_path)
+
+    if data.size == 0:
+        return []
+
+    # Convert normalized to pixel coords
+    box_w = data[:, 3] * img_width
+    box_h = data[:, 4] * img_height
+    x_min = data[:, 1] * img_width  - box_w / 2
+    y_min = data[:, 2] * img_height - box_h / 2
+    cls   = data[:, 0].astype(np.int32)
+
+    return list(zip(cls.tolist(), x_min.tolist(), y_min.tolist(), box_w.tolist(), box_h.tolist()))
+
+def visualize_image_with_boxes(main_path, image_path, label_path, fig, ax):
+    # Load image; draft() lets libjpeg subsample during decode, since the
+    # figure is rendered at roughly 1800x1200 anyway. Boxes are normalized,
+    # so denormalizing against the drafted size keeps them aligned.
+    img = Image.open(image_path)
+    img.draft("RGB", (1800, 1200))
+    img = img.convert("RGB")
     img_width, img_height = img.size
 
     # Load YOLO boxes
     boxes = load_yolo_annotations(label_path, img_width, img_height)
 
-    # Plot
-    fig, ax = plt.subplots(1,1, figsize=(12,8))
+    # Plot into the shared figure; clearing the axes is much cheaper than
+    # creating a new figure (backend init, font cache) per image
+    ax.cla()
     ax.imshow(img)
     ax.set_title(os.path.basename(image_path))
     # ax.axis("off")
 
-    # Add boxes
-    for cls, x_min, y_min, box_w, box_h in boxes:
-        # Rectangle: (x, y), width, height
-        rect = patches.Rectangle(
-            (x_min, y_min),
-            box_w,
-            box_h,
+    # Add boxes as one collection - much faster than one artist per rectangle
+    if boxes:
+        rects = [
+            patches.Rectangle((x_min, y_min), box_w, box_h)
+            for _, x_min, y_min, box_w, box_h in boxes
+        ]
+        ax.add_collection(PatchCollection(
+            rects,
             linewidth=2,
             edgecolor='r',  # red boxes
             facecolor='none'
-        )
-        ax.add_patch(rect)
+        ))
+
+    for cls, x_min, y_min, box_w, box_h in boxes:
         print("BBOX: ", x_min, y_min, box_w, box_h)
         # Optional: draw class id text
         ax.text(
@@ -86,19 +113,23 @@ def visualize_image_with_boxes(main_path,image_path, label_path):
 
     # Save the plot instead of showing (more reliable)
     out_path = r"C:\Users\Wojtek\Documents\GitHub\Tools\magisterka\temp_augment_data_dir_LARGER_augment_resized\visualizations"
-    plt.savefig(os.path.join(out_path,Path(IMAGE_PATH).stem+"_vis.jpg"), bbox_inches='tight', dpi=150)
-    plt.close(fig)  # Close to free memory
-    print(f"Visualization saved to {Path(IMAGE_PATH).stem}_vis.jpg")
+    fig.savefig(os.path.join(out_path,Path(image_path).stem+"_vis.jpg"), bbox_inches='tight', dpi=150)
+    print(f"Visualization saved to {Path(image_path).stem}_vis.jpg")
 
 if __name__ == "__main__":
+    # one figure reused for the whole batch
+    fig, ax = plt.subplots(1,1, figsize=(12,8))
+
     count = 0
     for filename in os.listdir(os.path.join(main_path,'images')):
         # if filename.endswith(".jpg"):
         filename = Path(filename).stem
         IMAGE_PATH = os.path.join(main_path,"images",filename+ ".jpg")
         LABEL_PATH = os.path.join(main_path,"labels",filename + ".txt")
-        visualize_image_with_boxes(main_path,IMAGE_PATH, LABEL_PATH)
+        visualize_image_with_boxes(main_path,IMAGE_PATH, LABEL_PATH, fig, ax)
         count += 1
         if count == 200:
             break
+
+    plt.close(fig)  # Close to free memory
         